@@ -1,26 +1,108 @@
 import argparse
 import arrow
-import fastfeedparser
+import asyncio
+import atexit
+import codecs
+import collections
+import contextlib
+import io
+import email.utils
 import logging
+import logging.handlers
+import queue
 import re
 import httpx
+import json
+import os
+import random
 import time
-import charset_normalizer  # Per detectar la codificació del feed
-from atproto import Client, client_utils, models
-from bs4 import BeautifulSoup
+from datetime import datetime, timezone
 import html  # Per desescapar entitats HTML
+from urllib.parse import urlparse
 
 # --- Logging ---
 LOG_PATH = "rss2bsky_test.log"  # Fitxer de log per a depuració
-logging.basicConfig(
-    format="%(asctime)s %(message)s",
-    filename=LOG_PATH,
-    encoding="utf-8",
-    level=logging.INFO,  # Nivell DEBUG per veure més detalls durant el test
-)
+LOG_MAX_BYTES = 1_000_000  # Rotem el fitxer en arribar a aquesta mida
+LOG_BACKUP_COUNT = 3
+DEFAULT_LOG_LEVEL = "WARNING"  # Amb --log-level INFO o DEBUG es veuen més detalls
+
+def setup_logging(level):
+    # Els missatges van a una cua i un fil de fons els escriu al fitxer, sense bloquejar el bucle principal
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)  # Buida la cua abans de sortir
+
+# --- Estat entre execucions (ETag/Last-Modified del feed) ---
+STATE_PATH = "rss2bsky_state.json"  # Al costat del fitxer de log
+
+# --- Reintents del login ---
+LOGIN_MAX_ATTEMPTS = 8
+LOGIN_INITIAL_BACKOFF = 10  # Segons; es dobla a cada intent
+LOGIN_MAX_BACKOFF = 600
+LOGIN_JITTER = 5
+
+# --- Memòria cau de metadades i imatges dels enllaços ---
+CACHE_DIR = os.path.expanduser("~/.cache/rss2bsky")
+CACHE_EXPIRE = 86400  # Un dia
+
+# --- Imports pesats (bs4, atproto, fastfeedparser...) es fan dins les funcions que els usen,
+# perquè una execució sense res nou no els hagi de carregar ---
+_bs4 = None
+
+def _get_bs():
+    global _bs4
+    if _bs4 is None:
+        from bs4 import BeautifulSoup
+        _bs4 = BeautifulSoup
+    return _bs4
+
+# --- Client HTTP compartit (reutilitza connexions i TLS entre peticions) ---
+HTTP_TIMEOUT = 10
+HTTP_HEADERS = {"User-Agent": "rss2bsky/1.0"}
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20)
+_HTTP = httpx.Client(http2=True, timeout=HTTP_TIMEOUT, headers=HTTP_HEADERS, limits=HTTP_LIMITS)
+
+# --- Límits per a les descàrregues en paral·lel ---
+MAX_CONCURRENT_FETCHES = 8  # Peticions simultànies en total
+MAX_FETCHES_PER_HOST = 4  # Peticions simultànies per servidor
+MAX_RETRY_AFTER = 60  # Segons màxims d'espera quan un servidor respon 429
+MAX_IMAGE_BYTES = 1_000_000  # Mida màxima d'un blob a Bluesky
+IMAGE_CHUNK_BYTES = 65536
+
+# --- Expressions per al text del post ---
+# Un enllaç no acaba mai en puntuació: a "Vegeu (https://a.b/c)." el ")." queda fora
+_RICH_RE = re.compile(r"""https?://\S*[^\s.,;:!?)\]»"']|#[A-Za-z0-9_]+""")
+_HTML_RE = re.compile(r"<[^>]+>")
+
+# --- Expressions per extreure les metadades de l'enllaç sense construir cap arbre HTML ---
+HEAD_SNIFF_BYTES = 65536  # El <head> sempre és al principi de la pàgina
+_META_TAG_RE = re.compile(rb"""<meta\s(?:[^>"']|"[^"]*"|'[^']*')*>""", re.I)  # Admet ">" dins els valors entre cometes
+_ATTR_RE = re.compile(rb"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+_TITLE_RE = re.compile(rb"<title[^>]*>(.*?)</title>", re.I | re.S)
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.I)
+
+# --- Detecció de la codificació del feed ---
+XML_PROLOG_BYTES = 1024  # La declaració XML sempre és al principi
+CHARSET_SNIFF_BYTES = 8192  # Mostra que es passa a charset_normalizer com a últim recurs
+_XML_ENCODING_RE = re.compile(rb"""<\?xml[^>]*encoding=["']([\w.:-]+)["']""", re.I)
 
 # --- Funció per corregir problemes de codificació ---
+# Primers caràcters típics de UTF-8 llegit com a latin-1: "Ã©" en lloc de "é", "Â·" en lloc de "·",
+# i "â\x80\x99" en lloc de "’" (cometes, guions i "€" comencen tots per "â\x80" o "â\x82")
+_MOJIBAKE_MARKERS = ("Ã", "Â", "â")
+
 def fix_encoding(text):
+    # Només intentem la conversió si el text sembla mal codificat
+    if not any(marker in text for marker in _MOJIBAKE_MARKERS):
+        return text
     try:
         # Intenta decodificar i reencodificar a UTF-8
         return text.encode("latin-1").decode("utf-8")
@@ -29,8 +111,19 @@ def fix_encoding(text):
         return text  # Retorna el text original si hi ha un error
 
 # --- Funció per desescapar caràcters unicode ---
+# Entitats habituals als títols; "&amp;" ha d'anar l'última perquè "&amp;lt;" quedi com "&lt;"
+_SIMPLE_ENTITIES = (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&#39;", "'"), ("&apos;", "'"), ("&amp;", "&"))
+_COMPLEX_ENTITY_RE = re.compile(r"&(?!amp;|lt;|gt;|quot;|#39;|apos;)")
+
 def desescapar_unicode(text):
+    if "&" not in text:
+        return text
     try:
+        # Si només hi ha entitats habituals n'hi ha prou amb replace(); la resta, html.unescape
+        if _COMPLEX_ENTITY_RE.search(text) is None:
+            for entity, char in _SIMPLE_ENTITIES:
+                text = text.replace(entity, char)
+            return text
         return html.unescape(text)  # Utilitza html.unescape per gestionar HTML entities
     except Exception as e:
         logging.warning(f"Error desescapant unicode: {e}")
@@ -38,77 +131,441 @@ def desescapar_unicode(text):
 
 # --- Funció per processar el títol ---
 def process_title(title):
+    # Cada pas només s'executa si el títol el necessita; un títol net només fa strip()
     try:
-        if is_html(title):
-            title_text = BeautifulSoup(title, "html.parser", from_encoding="utf-8").get_text().strip()
-        else:
-            title_text = title.strip()
+        title_text = title.strip()
+        if is_html(title_text):
+            title_text = _get_bs()(title_text, "lxml", from_encoding="utf-8").get_text().strip()
         title_text = desescapar_unicode(title_text)  # Desescapar HTML entities
-        title_text = fix_encoding(title_text)  # Corregir problemes de codificació
+        if not title_text.isascii():
+            title_text = fix_encoding(title_text)  # Corregir problemes de codificació
         return title_text
     except Exception as e:
         logging.warning(f"Error processant el títol: {e}")
         return title
 
-def fetch_link_metadata(url):
+# --- Limita les peticions concurrents, en total i per servidor ---
+class FetchLimiter:
+    def __init__(self, total=MAX_CONCURRENT_FETCHES, per_host=MAX_FETCHES_PER_HOST):
+        self._total = asyncio.Semaphore(total)
+        self._per_host = per_host
+        self._hosts = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        host = urlparse(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self._per_host)
+        # Primer el slot del servidor: qui espera un servidor ocupat no ha de bloquejar slots globals
+        async with self._hosts[host], self._total:
+            yield
+
+def retry_after_seconds(response):
+    # Retry-After pot ser un nombre de segons o una data HTTP
+    value = response.headers.get("Retry-After", "")
     try:
-        r = httpx.get(url, timeout=10)
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            delay = 1
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+async def limited_get(c, limiter, url):
+    # Un sol reintent si el servidor ens demana que esperem (429)
+    for attempt in range(2):
+        async with limiter.slot(url):
+            r = await c.get(url)
+        if r.status_code != 429 or attempt:
+            return r
+        delay = retry_after_seconds(r)
+        logging.info("Rate limited by %s, retrying in %.1fs", urlparse(url).netloc, delay)
+        await asyncio.sleep(delay)
+
+def _html_encoding(r, head):
+    # Primer la capçalera Content-Type, després <meta charset>, i si no utf-8
+    for encoding in (r.charset_encoding, _charset_from_meta(head)):
+        if encoding:
+            try:
+                return codecs.lookup(encoding).name
+            except LookupError:
+                pass
+    return "utf-8"
+
+def _charset_from_meta(head):
+    m = _META_CHARSET_RE.search(head)
+    return m.group(1).decode("ascii") if m else None
+
+def _meta_tags(head, encoding):
+    # Retorna {property/name: content} de les etiquetes <meta>, quedant-se amb la primera
+    metas = {}
+    for tag in _META_TAG_RE.finditer(head):
+        attrs = {}
+        for m in _ATTR_RE.finditer(tag.group()):
+            attrs[m.group(1).lower()] = m.group(2) or m.group(3) or m.group(4) or b""
+        key = attrs.get(b"property") or attrs.get(b"name")
+        if key and b"content" in attrs:
+            value = html.unescape(attrs[b"content"].decode(encoding, errors="replace")).strip()
+            metas.setdefault(key.decode(encoding, errors="replace").lower(), value)
+    return metas
+
+def _first_meta(metas, *keys):
+    # Primer valor no buit entre les claus, per ordre de preferència
+    for key in keys:
+        if metas.get(key):
+            return metas[key]
+    return None
+
+def _page_title(head, encoding):
+    # Només es busca el <title> si la pàgina no té cap meta de títol
+    title_tag = _TITLE_RE.search(head)
+    return html.unescape(title_tag.group(1).decode(encoding, errors="replace")).strip() if title_tag else ""
+
+async def fetch_link_metadata(c, limiter, url):
+    try:
+        r = await limited_get(c, limiter, url)
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        title = (soup.find("meta", property="og:title") or soup.find("title"))
-        desc = (soup.find("meta", property="og:description") or soup.find("meta", attrs={"name": "description"}))
-        image = (soup.find("meta", property="og:image") or soup.find("meta", attrs={"name": "twitter:image"}))
+        head = r.content[:HEAD_SNIFF_BYTES]
+        encoding = _html_encoding(r, head)
+        metas = _meta_tags(head, encoding)
         return {
-            "title": title["content"] if title and title.has_attr("content") else (title.text if title else ""),
-            "description": desc["content"] if desc and desc.has_attr("content") else "",
-            "image": image["content"] if image and image.has_attr("content") else None,
+            "title": _first_meta(metas, "og:title", "twitter:title") or _page_title(head, encoding),
+            "description": _first_meta(metas, "og:description", "description", "twitter:description") or "",
+            "image": _first_meta(metas, "og:image", "twitter:image"),
         }
     except Exception as e:
         logging.warning(f"Could not fetch link metadata for {url}: {e}")
         return {}
 
+async def fetch_image(c, limiter, image_url):
+    # Descàrrega en streaming: Bluesky rebutja blobs de més d'1 MB, així que parem abans de llegir-ne més
+    try:
+        for attempt in range(2):
+            delay = None
+            async with limiter.slot(image_url), c.stream("GET", image_url) as r:
+                if r.status_code == 429 and not attempt:
+                    delay = retry_after_seconds(r)
+                else:
+                    if r.status_code != 200:
+                        return None
+                    if int(r.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES:
+                        logging.info("Image too large, skipping: %s", image_url)
+                        return None
+                    buf = bytearray()
+                    async for chunk in r.aiter_bytes(IMAGE_CHUNK_BYTES):
+                        buf += chunk
+                        if len(buf) > MAX_IMAGE_BYTES:
+                            logging.info("Image too large, skipping: %s", image_url)
+                            return None
+                    return bytes(buf)
+            logging.info("Rate limited by %s, retrying in %.1fs", urlparse(image_url).netloc, delay)
+            await asyncio.sleep(delay)
+    except Exception as e:
+        logging.warning(f"Could not fetch image from {image_url}: {e}")
+        return None
+
+# --- La memòria cau és només una optimització: si falla, seguim sense ---
+def _open_cache():
+    try:
+        import diskcache
+
+        return diskcache.Cache(CACHE_DIR)
+    except Exception as e:
+        logging.warning(f"Could not open link cache at {CACHE_DIR}, continuing without it: {e}")
+        return None
+
+def _cache_get(cache, url):
+    if cache is None:
+        return None
+    try:
+        return cache.get(url)
+    except Exception as e:
+        logging.warning(f"Could not read {url} from the link cache: {e}")
+        return None
+
+def _cache_set(cache, url, value):
+    if cache is None:
+        return
+    try:
+        cache.set(url, value, expire=CACHE_EXPIRE)
+    except Exception as e:
+        logging.warning(f"Could not write {url} to the link cache: {e}")
+
+async def fetch_meta_and_image(c, limiter, cache, url):
+    # Si ja hem vist l'enllaç en una execució recent, no cal cap petició
+    cached = _cache_get(cache, url)
+    if cached is not None:
+        logging.info("Link metadata cache hit: %s", url)
+        return cached
+
+    # La imatge depèn de l'og:image, així que es descarrega dins la mateixa tasca
+    link_metadata = await fetch_link_metadata(c, limiter, url)
+    img_bytes = None
+    if link_metadata.get("image"):
+        img_bytes = await fetch_image(c, limiter, link_metadata["image"])
+    # No desem els errors (tampoc si ha fallat només la imatge), perquè es reintentin
+    if link_metadata and (img_bytes is not None or not link_metadata.get("image")):
+        _cache_set(cache, url, (link_metadata, img_bytes))
+    return link_metadata, img_bytes
+
+async def prefetch_entries(entries):
+    # Descarrega metadades i imatges de totes les entrades alhora, un sol cop per enllaç
+    limiter = FetchLimiter()
+    urls = list(dict.fromkeys(item.link for item in entries))
+    cache = _open_cache()
+    try:
+        async with httpx.AsyncClient(http2=True, timeout=HTTP_TIMEOUT, headers=HTTP_HEADERS, limits=HTTP_LIMITS) as c:
+            results = await asyncio.gather(*(fetch_meta_and_image(c, limiter, cache, url) for url in urls))
+    finally:
+        if cache is not None:
+            try:
+                cache.close()
+            except Exception as e:
+                logging.warning(f"Could not close the link cache: {e}")
+    by_url = dict(zip(urls, results))
+    return [by_url[item.link] for item in entries]
+
+def login(service_url, username, password):
+    from atproto import Client
+
+    client = Client(base_url=service_url)  # Inicialitzem directament amb el servidor personalitzat
+
+    backoff = LOGIN_INITIAL_BACKOFF
+    for attempt in range(1, LOGIN_MAX_ATTEMPTS + 1):
+        try:
+            logging.info("Attempting login to server: %s with user: %s", service_url, username)
+            client.login(username, password)
+            logging.info("Login successful for user: %s", username)
+            return client
+        except Exception as e:
+            logging.exception("Login exception (attempt %d/%d)", attempt, LOGIN_MAX_ATTEMPTS)
+            if attempt == LOGIN_MAX_ATTEMPTS:
+                raise
+            # Espera exponencial amb una mica d'atzar perquè diverses instàncies no reintentin alhora
+            time.sleep(backoff + random.uniform(0, LOGIN_JITTER))
+            backoff = min(backoff * 2, LOGIN_MAX_BACKOFF)
+
+def load_last_bsky(state, handle):
+    # Hora de l'últim post que hem publicat nosaltres, o None si no la tenim o no és vàlida
+    cached = state.get("last_bsky", {}).get(handle)
+    if not cached:
+        return None
+    try:
+        return arrow.get(cached)
+    except (arrow.parser.ParserError, TypeError, ValueError):
+        logging.warning(f"Ignoring invalid cached last post time for {handle}: {cached}")
+        return None
+
+def parse_timestamp(value):
+    # ISO 8601 (Atom i fastfeedparser) o RFC 822 (RSS) amb la llibreria estàndard; arrow només com a últim recurs
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        try:
+            dt = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return arrow.get(value).timestamp()
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
 def get_last_bsky(client, handle):
     timeline = client.get_author_feed(handle)
     for titem in timeline.feed:
         # Only care about top-level, non-reply posts
         if titem.reason is None and getattr(titem.post.record, "reply", None) is None:
-            logging.info("Record created %s", str(titem.post.record.created_at))
+            logging.info("Record created %s", titem.post.record.created_at)
             return arrow.get(titem.post.record.created_at)
     return arrow.get(0)
 
 def make_rich(content):
+    from atproto import client_utils
+
+    # Una sola passada: el text entre coincidències és text pla, i cada coincidència és un enllaç o un tag
     text_builder = client_utils.TextBuilder()
-    lines = content.split("\n")
-    for line in lines:
-        # If the line is a URL, make it a clickable link
-        if line.startswith("http"):
-            url = line.strip()
-            text_builder.link(url, url)
+    pos = 0
+    for m in _RICH_RE.finditer(content):
+        if m.start() > pos:
+            text_builder.text(content[pos:m.start()])
+        token = m.group()
+        if token.startswith("#"):
+            text_builder.tag(token, token[1:])
         else:
-            tag_split = re.split("(#[a-zA-Z0-9]+)", line)
-            for i, t in enumerate(tag_split):
-                if i == len(tag_split) - 1:
-                    t = t + "\n"
-                if t.startswith("#"):
-                    text_builder.tag(t, t[1:].strip())
-                else:
-                    text_builder.text(t)
+            text_builder.link(token, token)
+        pos = m.end()
+    if pos < len(content):
+        text_builder.text(content[pos:])
     return text_builder
 
-# --- Nova funció: Només retorna el 'blob' necessari per a la miniatura de l'enllaç ---
-def get_blob_from_url(image_url, client):
+# --- Només retorna el 'blob' necessari per a la miniatura de l'enllaç ---
+def get_blob_from_bytes(img_bytes, image_url, client):
     try:
-        r = httpx.get(image_url, timeout=10)
-        if r.status_code != 200:
-            return None
-        img_blob = client.upload_blob(r.content)
+        img_blob = client.upload_blob(img_bytes)
         return img_blob.blob
     except Exception as e:
-        logging.warning(f"Could not fetch/upload image from {image_url}: {e}")
+        logging.warning(f"Could not upload image from {image_url}: {e}")
         return None
 
+def make_embed(link, link_metadata, title_text, thumb_blob):
+    # Targeta d'enllaç; atproto.models només es carrega quan hi ha alguna cosa a publicar
+    if not (link_metadata.get("title") or link_metadata.get("description") or thumb_blob):
+        return None
+    from atproto import models
+
+    return models.AppBskyEmbedExternal.Main(
+        external=models.AppBskyEmbedExternal.External(
+            uri=link,
+            title=link_metadata.get("title") or title_text or "Enllaç",
+            description=link_metadata.get("description") or "",
+            thumb=thumb_blob,  # Aquí carreguem la imatge a la targeta
+        )
+    )
+
+def decode_feed(response):
+    # 1. Codificació de la capçalera Content-Type, 2. declaració XML, 3. charset_normalizer sobre una mostra
+    prolog = _XML_ENCODING_RE.search(response.content[:XML_PROLOG_BYTES])
+    for encoding in (response.charset_encoding, prolog.group(1).decode("ascii") if prolog else None):
+        if encoding:
+            try:
+                return response.content.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                logging.warning(f"El feed no es pot decodificar amb la codificació declarada: {encoding}")
+
+    import charset_normalizer  # Per detectar la codificació del feed
+
+    result = charset_normalizer.from_bytes(response.content[:CHARSET_SNIFF_BYTES]).best()
+    if result and result.encoding:
+        try:
+            return response.content.decode(result.encoding)
+        except (LookupError, UnicodeDecodeError):
+            pass
+
+    logging.warning("No s'ha pogut detectar la codificació del feed. Provant amb utf-8.")
+    try:
+        return response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        logging.warning("No s'ha pogut decodificar amb utf-8. Provant amb latin-1.")
+        return response.content.decode("latin-1")
+
+# --- Entrades del feed: només necessitem aquests tres camps ---
+FeedEntry = collections.namedtuple("FeedEntry", ["title", "link", "published"])
+
+# Espais de noms on busquem les entrades; els camps han de ser al mateix espai que l'entrada,
+# perquè <media:title>, <itunes:title> o <atom:link> dins un <item> no passin per davant dels de debò
+_ATOM_NS = "{http://www.w3.org/2005/Atom}"
+_RSS1_NS = "{http://purl.org/rss/1.0/}"
+_RSS09_NS = "{http://my.netscape.com/rdf/simple/0.9/}"
+_DC_NS = "{http://purl.org/dc/elements/1.1/}"
+_ENTRY_TAGS = {"item": "", _RSS1_NS + "item": _RSS1_NS, _RSS09_NS + "item": _RSS09_NS, _ATOM_NS + "entry": _ATOM_NS}
+
+def _entry_from_element(el, ns):
+    # Serveix per a <item> (RSS 0.9x/1.0/2.0) i <entry> (Atom); retorna None si hi falta algun camp
+    title = link = published = updated = None
+    for child in el:
+        tag = child.tag
+        if not isinstance(tag, str):
+            continue
+        if tag == ns + "title" and title is None:
+            title = "".join(child.itertext())
+        elif tag == ns + "link" and link is None:
+            href = child.get("href")
+            if href is None:
+                link = (child.text or "").strip() or None
+            elif child.get("rel", "alternate") == "alternate":
+                link = href.strip()
+        elif tag in (ns + "pubDate", ns + "published", _DC_NS + "date") and published is None:
+            published = (child.text or "").strip() or None
+        elif tag == ns + "updated" and updated is None:
+            updated = (child.text or "").strip() or None
+    published = _normalize_date(published or updated)
+    if title is None or not link or not published:
+        return None
+    return FeedEntry(title, link, published)
+
+def _normalize_date(value):
+    # Data ISO 8601 en UTC, com les de fastfeedparser; None si no es pot llegir amb un fus horari explícit
+    # (p. ex. "CEST" o "14/10/2026 10:00"), i llavors el feed es llegeix amb fastfeedparser
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            dt = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+    if dt.tzinfo is None:
+        return None
+    return dt.astimezone(timezone.utc).isoformat()
+
+def _parse_feed_lxml(feed_content):
+    from lxml import etree
+
+    entries = []
+    events = etree.iterparse(
+        io.BytesIO(feed_content.encode("utf-8")),
+        events=("end",),
+        encoding="utf-8",  # El contingut ja està decodificat: ignorem la declaració XML original
+        recover=True,
+        resolve_entities=False,
+        no_network=True,
+    )
+    for _, el in events:
+        ns = _ENTRY_TAGS.get(el.tag) if isinstance(el.tag, str) else None
+        if ns is None:
+            continue
+        entry = _entry_from_element(el, ns)
+        if entry is None:
+            raise ValueError("entrada del feed incompleta o amb una data sense fus horari")
+        entries.append(entry)
+        # Alliberem les entrades ja processades perquè l'arbre no creixi
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+    if not entries:
+        raise ValueError("cap entrada trobada")
+    return entries
+
+def parse_feed(feed_content):
+    # Extractor directe amb lxml; fastfeedparser només si el feed té una forma que no sabem llegir
+    try:
+        return _parse_feed_lxml(feed_content)
+    except Exception as e:
+        logging.info("Falling back to fastfeedparser: %s", e)
+    import fastfeedparser
+
+    feed = fastfeedparser.parse(feed_content)
+    return [FeedEntry(e.get("title"), e.get("link"), e.get("published")) for e in feed.entries]
+
+def load_state():
+    try:
+        with open(STATE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    # Escrivim a un fitxer temporal i el reanomenem perquè l'estat mai quedi a mitges
+    tmp_path = STATE_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, STATE_PATH)
+    except OSError as e:
+        logging.warning(f"Could not save state to {STATE_PATH}: {e}")
+
+def conditional_headers(feed_state):
+    headers = {}
+    if feed_state.get("etag"):
+        headers["If-None-Match"] = feed_state["etag"]
+    if feed_state.get("last_modified"):
+        headers["If-Modified-Since"] = feed_state["last_modified"]
+    return headers
+
 def is_html(text):
-    return bool(re.search(r'<.*?>', text))
+    # El test "in" és molt més barat que la regex i descarta gairebé tots els títols
+    return "<" in text and _HTML_RE.search(text) is not None
 
 def main():
     # --- Parse command-line arguments ---
@@ -120,7 +577,10 @@ def main():
     parser.add_argument("--service", default="https://bsky.social", help="Bluesky server URL (default: https://bsky.social)")
     # Nova opció per a l'idioma, per defecte en català ('ca')
     parser.add_argument("--lang", default="ca", help="Language code for the post (default: ca)")
+    parser.add_argument("--log-level", default=DEFAULT_LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help=f"Log file level (default: {DEFAULT_LOG_LEVEL})")
     args = parser.parse_args()
+    setup_logging(args.log_level)
     
     feed_url = args.rss_feed
     bsky_handle = args.bsky_handle
@@ -129,88 +589,96 @@ def main():
     service_url = args.service
     post_lang = args.lang
 
-    # --- Login ---
-    client = Client(base_url=service_url)  # Inicialitzem directament amb el servidor personalitzat
-    
-    backoff = 60
-    while True:
-        try:
-            logging.info(f"Attempting login to server: {service_url} with user: {bsky_username}")
-            client.login(bsky_username, bsky_password)
-            logging.info(f"Login successful for user: {bsky_username}")
-            break
-        except Exception as e:
-            logging.exception("Login exception")
-            time.sleep(backoff)
-            backoff = min(backoff + 60, 600)
-
-    # --- Get last Bluesky post time ---
-    last_bsky = get_last_bsky(client, bsky_handle)
+    # --- Fetch feed (GET condicional: si no ha canviat, no hi ha res a fer) ---
+    state = load_state()
+    feed_state = state.get("feeds", {}).get(feed_url, {})
+    response = _HTTP.get(feed_url, headers=conditional_headers(feed_state))
+    if response.status_code == 304:
+        logging.info("Feed not modified since last run: %s", feed_url)
+        return
+    response.raise_for_status()  # Comprova que la resposta sigui correcta
 
     # --- Parse feed ---
-    response = httpx.get(feed_url)
-    response.raise_for_status()  # Comprova que la resposta sigui correcta
+    feed_content = decode_feed(response)
 
-    try:
-        # Detecta automàticament la codificació i converteix a UTF-8
-        result = charset_normalizer.from_bytes(response.content).best()
-        if not result or not hasattr(result, "text"):
-            raise ValueError("No s'ha pogut detectar la codificació del feed o el text no és accessible.")
-        feed_content = result.text  # Contingut decodificat com UTF-8
-    except ValueError:
-        logging.warning("No s'ha pogut detectar la codificació amb charset_normalizer. Provant amb latin-1.")
+    entries = parse_feed(feed_content)  # Passa el contingut decodificat al parser
+
+    # --- Get last Bluesky post time (de l'estat desat; només consultem el timeline si no hi és) ---
+    client = None
+    last_bsky = load_last_bsky(state, bsky_handle)
+    if last_bsky is None:
+        client = login(service_url, bsky_username, bsky_password)
+        last_bsky = get_last_bsky(client, bsky_handle)
+        state.setdefault("last_bsky", {})[bsky_handle] = last_bsky.isoformat()
+        save_state(state)
+
+    # --- Fase 1: triem les entrades noves i en descarreguem metadades i imatges en paral·lel ---
+    last_ts = last_bsky.timestamp()
+    entries_to_post = []
+    for item in entries:
         try:
-            feed_content = response.content.decode("latin-1")
-        except UnicodeDecodeError:
-            logging.warning("No s'ha pogut decodificar amb latin-1. Provant amb utf-8 amb errors ignorats.")
-            feed_content = response.content.decode("utf-8", errors="ignore")
+            rss_time = parse_timestamp(item.published)
+        except (TypeError, ValueError):
+            logging.warning("Skipping entry with unparseable date %r: %s", item.published, item.link)
+            continue
+        # Els feeds van del més nou al més antic: a partir de la primera entrada ja publicada, la resta també ho estan
+        if rss_time <= last_ts:
+        #if False: # TEST MODE: Sempre publicar, independentment de la data
+            logging.debug("Not sending %s nor older entries", item.link)
+            break
+        logging.info("RSS Time: %s", item.published)
+        entries_to_post.append((item, rss_time))
+
+    prefetched = asyncio.run(prefetch_entries([item for item, _ in entries_to_post])) if entries_to_post else []
 
-    feed = fastfeedparser.parse(feed_content)  # Passa el contingut decodificat al parser
+    # --- Login (només si hi ha alguna cosa a publicar) ---
+    if entries_to_post and client is None:
+        client = login(service_url, bsky_username, bsky_password)
 
-    for item in feed.entries:
-        rss_time = arrow.get(item.published)
-        logging.info("RSS Time: %s", str(rss_time))
+    # --- Fase 2: pugem les miniatures i publiquem en sèrie (el Client d'atproto és síncron) ---
+    # Del més antic al més nou, i parant al primer error: així l'hora desada mai passa per davant
+    # d'una entrada que no s'ha publicat, i la pròxima execució la reintenta
+    all_posted = True
+    for (item, rss_time), (link_metadata, img_bytes) in reversed(list(zip(entries_to_post, prefetched))):
         # Processar el títol per evitar problemes de codificació
         title_text = process_title(item.title)
 
         post_text = f"{title_text}\n{item.link}"
         logging.info("Title+link used as content: %s", post_text)
         rich_text = make_rich(post_text)
-        logging.info("Rich text length: %d" % (len(rich_text.build_text())))
-        logging.info("Filtered Content length: %d" % (len(post_text)))
-        
-        # Si el RSS és més nou que l'últim post, publica
-        if rss_time > last_bsky:
-        #if True: # TEST MODE: Sempre publicar, independentment de la data
-            link_metadata = fetch_link_metadata(item.link)
-            
-            # --- 1. Obtenim el blob de la imatge per a la miniatura ---
-            thumb_blob = None
-            if link_metadata.get("image"):
-                thumb_blob = get_blob_from_url(link_metadata["image"], client)
-
-            # --- 2. Creem l'embed extern (targeta d'enllaç) i hi assignem la miniatura ---
-            embed = None
-            if link_metadata.get("title") or link_metadata.get("description") or thumb_blob:
-                embed = models.AppBskyEmbedExternal.Main(
-                    external=models.AppBskyEmbedExternal.External(
-                        uri=item.link,
-                        title=link_metadata.get("title") or title_text or "Enllaç",
-                        description=link_metadata.get("description") or "",
-                        thumb=thumb_blob,  # Aquí carreguem la imatge a la targeta
-                    )
-                )
-
-            # TEST MODE: No enviar el post, només registrar l'acció
-            try:
-                logging.info("Test mode: Preparing to send post %s" % (item.link))
-                # Afegim langs=[post_lang] per especificar l'idioma
-                client.send_post(rich_text, embed=embed, langs=[post_lang])
-                logging.info("Test mode: Post prepared %s" % (item.link))
-            except Exception as e:
-                logging.exception("Failed to prepare post %s" % (item.link))
-        else:
-            logging.debug("Not sending %s" % (item.link))
+        # build_text() recorre tot el builder: només el cridem si el missatge s'ha d'escriure
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Rich text length: %d", len(rich_text.build_text()))
+            logging.info("Filtered Content length: %d", len(post_text))
+
+        # --- 1. Pugem la imatge ja descarregada per obtenir el blob de la miniatura ---
+        thumb_blob = None
+        if img_bytes:
+            thumb_blob = get_blob_from_bytes(img_bytes, link_metadata["image"], client)
+
+        # --- 2. Creem l'embed extern (targeta d'enllaç) i hi assignem la miniatura ---
+        embed = make_embed(item.link, link_metadata, title_text, thumb_blob)
+
+        # TEST MODE: No enviar el post, només registrar l'acció
+        try:
+            logging.info("Test mode: Preparing to send post %s", item.link)
+            # Afegim langs=[post_lang] per especificar l'idioma
+            client.send_post(rich_text, embed=embed, langs=[post_lang])
+            logging.info("Test mode: Post prepared %s", item.link)
+            state.setdefault("last_bsky", {})[bsky_handle] = datetime.fromtimestamp(rss_time, timezone.utc).isoformat()
+            save_state(state)
+        except Exception as e:
+            logging.exception("Failed to prepare post %s", item.link)
+            all_posted = False
+            break
+
+    # --- Desem l'ETag només si tot s'ha publicat, perquè la pròxima execució reintenti el que ha fallat ---
+    if all_posted:
+        state.setdefault("feeds", {})[feed_url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        save_state(state)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import argparse
 import logging
+import random
 import time
 from atproto import Client
 
@@ -12,6 +13,12 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+# --- Reintents del login ---
+LOGIN_MAX_ATTEMPTS = 8
+LOGIN_INITIAL_BACKOFF = 10  # Segons; es dobla a cada intent
+LOGIN_MAX_BACKOFF = 600
+LOGIN_JITTER = 5
+
 def main():
     # --- Parse command-line arguments ---
     parser = argparse.ArgumentParser(description="Post RSS to Bluesky.")
@@ -30,17 +37,20 @@ def main():
     # SOLUCIÓ: Passem el base_url directament al constructor del Client
     client = Client(base_url=service_url)
     
-    backoff = 60
-    while True:
+    backoff = LOGIN_INITIAL_BACKOFF
+    for attempt in range(1, LOGIN_MAX_ATTEMPTS + 1):
         try:
             logging.info(f"Attempting login to server: {service_url} with user: {bsky_username}")
             client.login(bsky_username, bsky_password)
             logging.info(f"Login successful for user: {bsky_username}")
             break
         except Exception as e:
-            logging.exception("Login exception")
-            time.sleep(backoff)
-            backoff = min(backoff + 60, 600)
+            logging.exception("Login exception (attempt %d/%d)", attempt, LOGIN_MAX_ATTEMPTS)
+            if attempt == LOGIN_MAX_ATTEMPTS:
+                raise
+            # Espera exponencial amb una mica d'atzar perquè diverses instàncies no reintentin alhora
+            time.sleep(backoff + random.uniform(0, LOGIN_JITTER))
+            backoff = min(backoff * 2, LOGIN_MAX_BACKOFF)
 
 if __name__ == "__main__":
     main()